@@ -1,36 +1,45 @@
 import json
+import os
+from pathlib import Path
 
-from datasets import load_dataset
-from transformers import (Wav2Vec2CTCTokenizer, Wav2Vec2FeatureExtractor,
-                          Wav2Vec2Processor)
+from datasets import load_dataset, load_from_disk
 
-from utils import extract_all_chars, speech_file_to_array_fn
+from utils import (extract_all_chars, get_audio_from_shard,
+                   get_int16_audio_from_path, get_processor)
 
 
 def make_vocab(dataset_train, dataset_test):
     vocab_train = dataset_train.map(
         extract_all_chars,
         batched=True,
-        batch_size=-1,
+        batch_size=10000,
+        num_proc=min(os.cpu_count(), 16),
         keep_in_memory=True,
         remove_columns=dataset_train.column_names,
     )
     vocab_test = dataset_test.map(
         extract_all_chars,
         batched=True,
-        batch_size=-1,
+        batch_size=10000,
+        num_proc=min(os.cpu_count(), 16),
         keep_in_memory=True,
         remove_columns=dataset_test.column_names,
     )
-    vocab_list = list(set(vocab_train["vocab"][0]) | set(vocab_test["vocab"][0]))
+    vocab_list = sorted(set().union(*vocab_train["vocab"], *vocab_test["vocab"]))
     vocab_dict = {v: k for k, v in enumerate(vocab_list)}
     vocab_dict["|"] = vocab_dict[" "]
     del vocab_dict[" "]
     vocab_dict["[UNK]"] = len(vocab_dict)
     vocab_dict["[PAD]"] = len(vocab_dict)
 
-    with open("vocab.json", "w") as vocab_file:
-        json.dump(vocab_dict, vocab_file)
+    new_vocab = json.dumps(vocab_dict, ensure_ascii=False, sort_keys=True)
+    old_vocab = None
+    if os.path.isfile("vocab.json"):
+        with open("vocab.json", encoding="utf-8") as vocab_file:
+            old_vocab = vocab_file.read()
+    if new_vocab != old_vocab:
+        with open("vocab.json", "w", encoding="utf-8") as vocab_file:
+            vocab_file.write(new_vocab)
 
 
 def dataset(args):
@@ -46,59 +55,57 @@ def dataset(args):
         make_vocab(dataset_train, dataset_test)
         print("------make_vocab_done------")
 
-    dataset_train = dataset_train.map(
-        speech_file_to_array_fn, remove_columns=dataset_train.column_names
-    )
-    dataset_test = dataset_test.map(
-        speech_file_to_array_fn, remove_columns=dataset_test.column_names
-    )
-
-    print("------speech_file_to_array_done------")
-
-    tokenizer = Wav2Vec2CTCTokenizer(
-        args["vocab_path"],
-        unk_token="[UNK]",
-        pad_token="[PAD]",
-        word_delimiter_token="|",
-    )
-    feature_extractor = Wav2Vec2FeatureExtractor(
-        feature_size=1,
-        sampling_rate=16000,
-        padding_value=0.0,
-        do_normalize=True,
-        return_attention_mask=True,
-    )
-    processor = Wav2Vec2Processor(
-        feature_extractor=feature_extractor, tokenizer=tokenizer
-    )
-
-    def prepare_dataset(batch):
-        assert (
-            len(set(batch["sampling_rate"])) == 1
-        ), f"Make sure all inputs have the same sampling rate of {processor.feature_extractor.sampling_rate}."
-        batch["input_values"] = processor(
-            batch["speech"], sampling_rate=batch["sampling_rate"][0]
-        ).input_values
+    # Normalization happens in DataCollatorCTCWithPadding, so the training
+    # processor does not normalize.
+    processor = get_processor(args["vocab_path"], do_normalize=False)
+
+    def load_and_prepare(batch):
+        if "shard_path" in batch:
+            batch["input_values"] = [
+                get_audio_from_shard(path, start, num_samples)
+                for path, start, num_samples in zip(
+                    batch["shard_path"], batch["start"], batch["num_samples"]
+                )
+            ]
+        else:
+            batch["input_values"] = [
+                get_int16_audio_from_path(Path(path)) for path in batch["audio_path"]
+            ]
+        batch["length"] = [len(values) for values in batch["input_values"]]
 
         with processor.as_target_processor():
-            batch["labels"] = processor(batch["target_text"]).input_ids
+            batch["labels"] = processor(batch["transcript"]).input_ids
         return batch
 
-    dataset_train = dataset_train.map(
-        prepare_dataset,
-        remove_columns=dataset_train.column_names,
-        batch_size=4,
-        num_proc=48,
-        batched=True,
-    )
-    dataset_test = dataset_test.map(
-        prepare_dataset,
-        remove_columns=dataset_test.column_names,
-        batch_size=4,
-        num_proc=48,
-        batched=True,
-    )
-
-    print("------prepare_dataset_done------")
+    cache_train = os.path.join(args["prepared_data_dir"], "train")
+    cache_test = os.path.join(args["prepared_data_dir"], "test")
+
+    if os.path.isdir(cache_train) and os.path.isdir(cache_test):
+        dataset_train = load_from_disk(cache_train)
+        dataset_test = load_from_disk(cache_test)
+
+        print("------load_prepared_dataset_done------")
+    else:
+        dataset_train = dataset_train.map(
+            load_and_prepare,
+            remove_columns=dataset_train.column_names,
+            batch_size=128,
+            num_proc=min(os.cpu_count(), 16),
+            batched=True,
+        )
+        dataset_test = dataset_test.map(
+            load_and_prepare,
+            remove_columns=dataset_test.column_names,
+            batch_size=128,
+            num_proc=min(os.cpu_count(), 16),
+            batched=True,
+        )
+        dataset_train.save_to_disk(cache_train)
+        dataset_test.save_to_disk(cache_test)
+
+        print("------prepare_dataset_done------")
+
+    dataset_train.set_format("torch")
+    dataset_test.set_format("torch")
 
     return dataset_train, dataset_test, processor
@@ -0,0 +1,61 @@
+import json
+from pathlib import Path
+
+import numpy as np
+import typer
+
+from utils import get_int16_audio_from_path, makedirs
+
+SAMPLES_PER_SHARD = 16000 * 60 * 30
+
+
+def pack(
+    manifest_path: str,
+    output_dir: str,
+    samples_per_shard: int = SAMPLES_PER_SHARD,
+):
+    makedirs(output_dir)
+    output_dir = Path(output_dir)
+
+    packed_rows = []
+    shard_id = -1
+    shard_path = None
+    shard_file = None
+    shard_samples = 0
+
+    with open(manifest_path, encoding="utf-8") as manifest:
+        for line in manifest:
+            row = json.loads(line)
+            audio = get_int16_audio_from_path(Path(row["audio_path"]))
+
+            if shard_file is None or shard_samples >= samples_per_shard:
+                if shard_file is not None:
+                    shard_file.close()
+                shard_id += 1
+                shard_path = output_dir / f"shard_{shard_id}.bin"
+                shard_file = shard_path.open("wb")
+                shard_samples = 0
+
+            np.asarray(audio).tofile(shard_file)
+            packed_rows.append(
+                {
+                    "shard_path": str(shard_path),
+                    "start": shard_samples,
+                    "num_samples": len(audio),
+                    "transcript": row["transcript"],
+                }
+            )
+            shard_samples += len(audio)
+
+    if shard_file is not None:
+        shard_file.close()
+
+    with (output_dir / "manifest.json").open("w", encoding="utf-8") as manifest:
+        for row in packed_rows:
+            manifest.write(json.dumps(row, ensure_ascii=False) + "\n")
+
+    print(f"------pack_shards_done: {shard_id + 1} shards------")
+
+
+if __name__ == "__main__":
+    typer.run(pack)
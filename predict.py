@@ -5,10 +5,9 @@ import torch
 import typer
 import yaml
 from tqdm import tqdm
-from transformers import (Wav2Vec2CTCTokenizer, Wav2Vec2FeatureExtractor,
-                          Wav2Vec2ForCTC, Wav2Vec2Processor)
+from transformers import Wav2Vec2ForCTC
 
-from utils import get_audio_from_path, makedirs
+from utils import get_audio_from_path, get_processor, makedirs
 
 app = typer.Typer()
 
@@ -18,12 +17,6 @@ def predict_one():
     with open("config_predict.yml") as f:
         args = yaml.load(f, Loader=yaml.FullLoader)
 
-    tokenizer = Wav2Vec2CTCTokenizer(
-        args["vocab_path"],
-        unk_token="[UNK]",
-        pad_token="[PAD]",
-        word_delimiter_token="|",
-    )
     if args["device"] == 'gpu':
         device = torch.device('cuda')
     elif args["device"] == 'cpu':
@@ -32,16 +25,7 @@ def predict_one():
         assert NotImplementedError('Not implemented device')
 
     model = Wav2Vec2ForCTC.from_pretrained(args["checkpoint_path"]).to(device)
-    feature_extractor = Wav2Vec2FeatureExtractor(
-        feature_size=1,
-        sampling_rate=16000,
-        padding_value=0.0,
-        do_normalize=True,
-        return_attention_mask=True,
-    )
-    processor = Wav2Vec2Processor(
-        feature_extractor=feature_extractor, tokenizer=tokenizer
-    )
+    processor = get_processor(args["vocab_path"])
 
     standard_sample_rate = 16000
     file_dir = Path(args["input_dir"])
@@ -71,12 +55,7 @@ def predict_all():
     with open("config_predict.yml") as f:
         args = yaml.load(f, Loader=yaml.FullLoader)
 
-    tokenizer = Wav2Vec2CTCTokenizer(
-        args["vocab_path"],
-        unk_token="[UNK]",
-        pad_token="[PAD]",
-        word_delimiter_token="|",
-    )
+    processor = get_processor(args["vocab_path"])
     checkpoint_path = Path(args["checkpoint_dir"])
     checkpoints = checkpoint_path.glob("checkpoint-*")
 
@@ -99,16 +78,6 @@ def predict_all():
 
     for checkpoint in tqdm(checkpoints):
         model = Wav2Vec2ForCTC.from_pretrained(checkpoint).to(device)
-        feature_extractor = Wav2Vec2FeatureExtractor(
-            feature_size=1,
-            sampling_rate=16000,
-            padding_value=0.0,
-            do_normalize=True,
-            return_attention_mask=True,
-        )
-        processor = Wav2Vec2Processor(
-            feature_extractor=feature_extractor, tokenizer=tokenizer
-        )
 
         for (file_name, audio) in audios:
             inputs = processor(
@@ -1,22 +1,30 @@
 import warnings
+from functools import partial
 
 import numpy as np
+import torch
 import yaml
+from datasets import load_metric
 from transformers import Trainer, TrainingArguments, Wav2Vec2ForCTC
 
 from dataset import dataset
-from utils import DataCollatorCTCWithPadding, compute_metrics
+from utils import (DataCollatorCTCWithPadding, compute_metrics, get_processor,
+                   preprocess_logits_for_metrics)
 
 
 def train():
     warnings.filterwarnings("ignore", category=np.VisibleDeprecationWarning)
     warnings.filterwarnings("ignore", category=UserWarning)
 
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+
     with open("config_train.yml") as f:
         args = yaml.load(f, Loader=yaml.FullLoader)
 
     dataset_train, dataset_test, processor = dataset(args)
-    data_collator = DataCollatorCTCWithPadding(processor=processor, padding=True)
+    data_collator = DataCollatorCTCWithPadding()
+    cer_metric = load_metric("cer")
 
     model = Wav2Vec2ForCTC.from_pretrained(
         args["pretrained_checkpoint_dir"],
@@ -25,7 +33,6 @@ def train():
         feat_proj_dropout=args["feat_proj_dropout"],
         mask_time_prob=args["mask_time_prob"],
         layerdrop=args["layerdrop"],
-        # gradient_checkpointing=args["gradient_checkpointing"],
         ctc_loss_reduction=args["ctc_loss_reduction"],
         pad_token_id=processor.tokenizer.pad_token_id,
         vocab_size=len(processor.tokenizer),
@@ -37,12 +44,16 @@ def train():
     training_args = TrainingArguments(
         output_dir=args["checkpoint_dir"],
         group_by_length=args["group_by_length"],
+        length_column_name="length",
         per_device_train_batch_size=args["batch_size"],
         per_device_eval_batch_size=args["batch_size"],
         gradient_accumulation_steps=args["gradient_accumulation_steps"],
+        gradient_checkpointing=args["gradient_checkpointing"],
+        gradient_checkpointing_kwargs={"use_reentrant": False},
         evaluation_strategy=args["evaluation_strategy"],
         num_train_epochs=args["num_train_epochs"],
-        fp16=args["fp16"],
+        fp16=args["fp16"] and not args["bf16"],
+        bf16=args["bf16"],
         save_steps=args["save_steps"],
         eval_steps=args["eval_steps"],
         logging_steps=args["logging_steps"],
@@ -51,6 +62,9 @@ def train():
         warmup_steps=args["warmup_steps"],
         save_total_limit=args["save_total_limit"],
         dataloader_num_workers=args["dataloader_num_workers"],
+        dataloader_pin_memory=True,
+        dataloader_prefetch_factor=args["prefetch_factor"],
+        torch_compile=True,
     )
 
     print("-------train_ready_done---------")
@@ -59,10 +73,16 @@ def train():
         model=model,
         data_collator=data_collator,
         args=training_args,
-        compute_metrics=compute_metrics,
+        compute_metrics=partial(
+            compute_metrics, processor=processor, cer_metric=cer_metric
+        ),
+        preprocess_logits_for_metrics=preprocess_logits_for_metrics,
         train_dataset=dataset_train,
         eval_dataset=dataset_test,
-        tokenizer=processor.feature_extractor,
+        # The training processor has do_normalize=False because the collator
+        # normalizes; export a normalizing extractor so checkpoints stay
+        # self-consistent for Wav2Vec2Processor.from_pretrained consumers.
+        tokenizer=get_processor(args["vocab_path"]).feature_extractor,
     )
 
     print("-------training_start!---------")
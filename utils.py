@@ -1,15 +1,14 @@
 import os
 import re
-from dataclasses import dataclass
-from pathlib import Path
-from typing import Dict, List, Optional, Union
+from functools import lru_cache
+from typing import Dict, List, Union
 
 import librosa
 import numpy as np
 import soundfile
 import torch
-from datasets import load_metric
-from transformers import Wav2Vec2Processor
+from transformers import (Wav2Vec2CTCTokenizer, Wav2Vec2FeatureExtractor,
+                          Wav2Vec2Processor)
 
 
 def remove_special_characters(batch):
@@ -22,15 +21,16 @@ def remove_special_characters(batch):
 
 def extract_all_chars(batch):
     all_text = " ".join(batch["transcript"])
-    vocab = list(set(all_text))
-    return {"vocab": [vocab], "all_text": [all_text]}
+    codepoints = np.frombuffer(all_text.encode("utf-32-le"), dtype=np.uint32)
+    vocab = [chr(c) for c in np.unique(codepoints)]
+    return {"vocab": [vocab]}
 
 
 def get_audio_from_path(file_path):
     standard_sample_rate = 16000
     if file_path.suffix == ".pcm":
-        with file_path.open("rb") as audio_file:
-            audio = np.fromfile(audio_file, dtype=np.int16).astype(np.single) / 32768
+        samples = np.memmap(file_path, dtype=np.int16, mode="r")
+        audio = np.multiply(samples, np.float32(1.0 / 32768.0), dtype=np.float32)
     else:
         audio, sample_rate = soundfile.read(file_path, dtype=np.single, always_2d=True)
         audio = audio.mean(axis=1)
@@ -42,21 +42,60 @@ def get_audio_from_path(file_path):
     return audio
 
 
-def speech_file_to_array_fn(batch):
-    audio = get_audio_from_path(Path(batch["audio_path"]))
-    batch["speech"] = audio
-    batch["sampling_rate"] = 16000
-    batch["target_text"] = batch["transcript"]
-    return batch
+# Shard memmaps are cached per process so each map worker reopens a
+# shard at most once.
+_shard_memmaps = {}
+
+
+def get_audio_from_shard(shard_path, start, length):
+    shard = _shard_memmaps.get(shard_path)
+    if shard is None:
+        shard = np.memmap(shard_path, dtype=np.int16, mode="r")
+        _shard_memmaps[shard_path] = shard
+    return shard[start : start + length]
+
+
+def get_int16_audio_from_path(file_path):
+    if file_path.suffix == ".pcm":
+        return np.memmap(file_path, dtype=np.int16, mode="r")
+    audio = get_audio_from_path(file_path)
+    return np.clip(audio * 32768.0, -32768, 32767).astype(np.int16)
+
+
+@lru_cache()
+def get_processor(vocab_path, do_normalize=True):
+    tokenizer = Wav2Vec2CTCTokenizer(
+        vocab_path,
+        unk_token="[UNK]",
+        pad_token="[PAD]",
+        word_delimiter_token="|",
+    )
+    feature_extractor = Wav2Vec2FeatureExtractor(
+        feature_size=1,
+        sampling_rate=16000,
+        padding_value=0.0,
+        do_normalize=do_normalize,
+        return_attention_mask=True,
+    )
+    return Wav2Vec2Processor(feature_extractor=feature_extractor, tokenizer=tokenizer)
+
 
+def preprocess_logits_for_metrics(logits, labels):
+    return logits.argmax(dim=-1)
 
-def compute_metrics(pred, processor):
-    cer_metric = load_metric("cer")
-    pred_logits = pred.predictions
-    pred_ids = np.argmax(pred_logits, axis=-1)
-    pred.label_ids[pred.label_ids == -100] = processor.tokenizer.pad_token_id
+
+def compute_metrics(pred, processor, cer_metric):
+    # The eval loop concatenates variable-length prediction batches with
+    # padding_index=-100, so predictions need the same pad-id substitution
+    # as the labels before decoding.
+    pred_ids = np.where(
+        pred.predictions == -100, processor.tokenizer.pad_token_id, pred.predictions
+    )
+    labels = np.where(
+        pred.label_ids == -100, processor.tokenizer.pad_token_id, pred.label_ids
+    )
     pred_str = processor.batch_decode(pred_ids)
-    label_str = processor.batch_decode(pred.label_ids, group_tokens=False)
+    label_str = processor.batch_decode(labels, group_tokens=False)
     cer = cer_metric.compute(predictions=pred_str, references=label_str)
     return {"cer": cer}
 
@@ -69,39 +108,37 @@ def makedirs(path):
             raise
 
 
-@dataclass
 class DataCollatorCTCWithPadding:
-    processor: Wav2Vec2Processor
-    padding: Union[bool, str] = True
-    max_length: Optional[int] = None
-    max_length_labels: Optional[int] = None
-    pad_to_multiple_of: Optional[int] = None
-    pad_to_multiple_of_labels: Optional[int] = None
-
     def __call__(
         self, features: List[Dict[str, Union[List[int], torch.Tensor]]]
     ) -> Dict[str, torch.Tensor]:
-        input_features = [
-            {"input_values": feature["input_values"]} for feature in features
+        input_values = [
+            torch.as_tensor(feature["input_values"]) for feature in features
         ]
-        label_features = [{"input_ids": feature["labels"]} for feature in features]
-        batch = self.processor.pad(
-            input_features,
-            padding=self.padding,
-            max_length=self.max_length,
-            pad_to_multiple_of=self.pad_to_multiple_of,
-            return_tensors="pt",
+        lengths = torch.tensor([values.shape[0] for values in input_values])
+        speech = torch.nn.utils.rnn.pad_sequence(input_values, batch_first=True).to(
+            torch.float32
         )
-        with self.processor.as_target_processor():
-            labels_batch = self.processor.pad(
-                label_features,
-                padding=self.padding,
-                max_length=self.max_length_labels,
-                pad_to_multiple_of=self.pad_to_multiple_of_labels,
-                return_tensors="pt",
-            )
-        labels = labels_batch["input_ids"].masked_fill(
-            labels_batch.attention_mask.ne(1), -100
+        attention_mask = torch.arange(speech.shape[1])[None, :] < lengths[:, None]
+
+        # Zero-mean unit-variance normalization over the unpadded region;
+        # it is invariant to the int16 scale, so the 1/32768 dequantization
+        # factor drops out here.
+        denom = lengths[:, None].to(torch.float32)
+        speech = (speech - speech.sum(dim=1, keepdim=True) / denom) * attention_mask
+        var = speech.pow(2).sum(dim=1, keepdim=True) / denom
+        speech = speech / torch.sqrt(var + 1e-7)
+
+        labels = torch.nn.utils.rnn.pad_sequence(
+            [
+                torch.as_tensor(feature["labels"], dtype=torch.long)
+                for feature in features
+            ],
+            batch_first=True,
+            padding_value=-100,
         )
-        batch["labels"] = labels
-        return batch
+        return {
+            "input_values": speech,
+            "attention_mask": attention_mask.long(),
+            "labels": labels,
+        }